@@ -1,167 +1,318 @@
 import json
 import hashlib
+import sys
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from itertools import count
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DIFFICULTY = 4
+DIFFICULTY_TARGET = (1 << (256 - 4 * DIFFICULTY)).to_bytes(32, 'big')
+MINING_BATCH = 1 << 14
+EMPTY_ROOT = b''
+
+
+def dump_json(data):
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(data, separators=(',', ':')).encode()
+
+
+def load_json(line):
+    if orjson is not None:
+        data = orjson.loads(line)
+        # orjson reads integers beyond 64 bits as floats, so lines holding such values are re-read with json
+        if not has_wide_float(data):
+            return data
+    return json.loads(line)
+
+
+def has_wide_float(data):
+    if isinstance(data, float):
+        return abs(data) >= 2 ** 63
+    if isinstance(data, dict):
+        return any(has_wide_float(value) for value in data.values())
+    if isinstance(data, list):
+        return any(has_wide_float(value) for value in data)
+    return False
+
+
+def serialize_transactions(transactions):
+    return json.dumps(transactions, sort_keys=True, separators=(',', ':')).encode()
+
+
+def intern_name(name):
+    return sys.intern(name) if isinstance(name, str) else name
+
+
+def fingerprint_leaves(leaves):
+    return hashlib.sha256('\n'.join(leaves).encode(), usedforsecurity=False).digest()
 
 
 class MerkleTree:
-    def __init__(self, transactions, merkle_root=''):
-        if merkle_root == '':
+    def __init__(self, transactions, merkle_root=None):
+        if merkle_root is None:
             self.merkle_root = self.create_merkle_root(transactions)
         else:
             self.merkle_root = merkle_root
 
     def create_merkle_root(self, transactions):
         if len(transactions) == 0:
-            return ''
-        if len(transactions) == 1:
-            return hashlib.sha256(transactions[0].encode()).hexdigest()
-
-        new_level = []
-        for i in range(0, len(transactions) - 1, 2):
-            new_level.append(self.hash_pair(transactions[i], transactions[i + 1]))
-
-        if len(transactions) % 2 == 1:
-            new_level.append(self.hash_pair(transactions[-1], transactions[-1]))
-
-        return self.create_merkle_root(new_level)
-
-    def hash_pair(self, left, right):
-        return hashlib.sha256((left + right).encode()).hexdigest()
+            return EMPTY_ROOT
+        level = b''.join(hashlib.sha256(tx.encode(), usedforsecurity=False).digest() for tx in transactions)
+        return self.hash_level(level)
+
+    def hash_level(self, level):
+        level = bytearray(level)
+        size = len(level)
+        while size > 32:
+            if size % 64 == 32:
+                level[size:size + 32] = level[size - 32:size]
+                size += 32
+
+            # node inputs are always one 64-byte block, so SHA-256 adds the same padding block to each;
+            # hashlib has no compression-level API, so its schedule cannot be precomputed from here
+            with memoryview(level) as view:
+                for i in range(0, size, 64):
+                    view[i // 2:i // 2 + 32] = hashlib.sha256(view[i:i + 64], usedforsecurity=False).digest()
+            size //= 2
+        return bytes(level[:32])
 
 
 class Block:
-    def __init__(self, transactions, previous_hash):
-        self.timestamp = datetime.now()
+    def __init__(self, transactions, previous_hash, timestamp=None):
+        self.timestamp = datetime.now() if timestamp is None else timestamp
         self.transactions = transactions
         self.previous_hash = previous_hash
-        self.merkle_tree = MerkleTree([str(tx) for tx in transactions])
+        self._merkle_tree = None
+        self._verified_merkle = None
         self.nonce = 0
-        self.hash = self.generate_hash()
+        self._hash = None
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = self.generate_hash()
+        return self._hash
+
+    @hash.setter
+    def hash(self, block_hash):
+        self._hash = block_hash
+
+    @property
+    def merkle_tree(self):
+        if self._merkle_tree is None:
+            self._merkle_tree = MerkleTree(self.merkle_leaves())
+        return self._merkle_tree
+
+    @merkle_tree.setter
+    def merkle_tree(self, merkle_tree):
+        self._merkle_tree = merkle_tree
+
+    def build_merkle_tree(self):
+        leaves = self.merkle_leaves()
+        self._merkle_tree = MerkleTree(leaves)
+        self._verified_merkle = (fingerprint_leaves(leaves), self._merkle_tree.merkle_root)
+
+    def merkle_leaves(self):
+        return [str(tx) for tx in self.transactions]
 
     def generate_hash(self):
-        block_contents = str(self.timestamp) + str(self.transactions) + str(self.previous_hash) + str(
-            self.nonce) + self.merkle_tree.merkle_root
-        block_hash = hashlib.sha256(block_contents.encode()).hexdigest()
+        block_contents = b''.join((self.pow_prefix(), b'%d' % self.nonce, self.merkle_tree.merkle_root))
+        block_hash = hashlib.sha256(block_contents, usedforsecurity=False).digest()
         return block_hash
 
+    def verify_hash(self):
+        return self.hash == self.generate_hash()
+
+    def pow_prefix(self):
+        return b''.join((str(self.timestamp).encode(), serialize_transactions(self.transactions), self.previous_hash))
+
     def verify_transactions(self):
-        new_merkle_tree = MerkleTree(transactions=[str(tx) for tx in self.transactions])
+        if not self.transactions:
+            return self.merkle_tree.merkle_root == EMPTY_ROOT
+        leaves = self.merkle_leaves()
+        verified = (fingerprint_leaves(leaves), self.merkle_tree.merkle_root)
+        if verified == self._verified_merkle:
+            return True
+        if MerkleTree(leaves).merkle_root != self.merkle_tree.merkle_root:
+            return False
+        self._verified_merkle = verified
+        return True
+
+    def deep_verify_transactions(self):
+        new_merkle_tree = MerkleTree(transactions=self.merkle_leaves())
         return new_merkle_tree.merkle_root == self.merkle_tree.merkle_root
 
     def to_dict(self):
         return {
             'timestamp': str(self.timestamp),
             'transactions': self.transactions,
-            'previous_hash': self.previous_hash,
+            'previous_hash': self.previous_hash.hex(),
             'nonce': self.nonce,
-            'hash': self.hash,
-            'merkle_root': self.merkle_tree.merkle_root
+            'hash': self.hash.hex(),
+            'merkle_root': self.merkle_tree.merkle_root.hex()
         }
 
 
 def from_dict(data):
-    block = Block(data['transactions'], data['previous_hash'])
-    block.timestamp = datetime.fromisoformat(data['timestamp'])
+    for transaction in data['transactions']:
+        transaction['sender'] = intern_name(transaction['sender'])
+        transaction['receiver'] = intern_name(transaction['receiver'])
+    block = Block(data['transactions'], bytes.fromhex(data['previous_hash']),
+                  datetime.fromisoformat(data['timestamp']))
     block.nonce = data['nonce']
-    block.hash = data['hash']
-    block.merkle_tree = MerkleTree('', data['merkle_root'])
+    block.hash = bytes.fromhex(data['hash'])
+    block.merkle_tree = MerkleTree(None, bytes.fromhex(data['merkle_root']))
     return block
 
 
+def mine(prefix_hasher, suffix, start=0, stride=1, stop=None):
+    copy = prefix_hasher.copy
+    target = DIFFICULTY_TARGET
+    nonces = count(start, stride) if stop is None else range(start, stop, stride)
+    for nonce in nonces:
+        hasher = copy()
+        hasher.update(b'%d' % nonce)
+        hasher.update(suffix)
+        digest = hasher.digest()
+        if digest < target:
+            return nonce, digest
+    return None
+
+
+def mine_range(prefix, suffix, start, stride, stop):
+    return mine(hashlib.sha256(prefix, usedforsecurity=False), suffix, start, stride, stop)
+
+
 class Blockchain:
-    def __init__(self):
+    def __init__(self, mining_workers=1, verify_workers=1):
+        self.mining_workers = mining_workers
+        self.verify_workers = verify_workers
         self.chain = []
         self.current_transactions = []
+        self._balances = defaultdict(int)
+        self._extremes = {}
+        self._transaction_count = 0
         self.create_genesis_block()
 
     def create_genesis_block(self):
-        genesis_block = Block(transactions=[], previous_hash="0")
+        genesis_block = Block(transactions=[], previous_hash=b'\x00' * 32)
         self.chain.append(genesis_block)
 
     def add_block(self):
         previous_block = self.chain[-1]
         new_block = Block(transactions=self.current_transactions, previous_hash=previous_block.hash)
+        new_block.build_merkle_tree()
         new_block.hash = self.proof_of_work(new_block)
         self.chain.append(new_block)
+        self._index_transactions(new_block.transactions)
         self.current_transactions = []
 
     def proof_of_work(self, block):
-        while block.hash[:4] != "0000":
-            block.nonce += 1
-            block.hash = block.generate_hash()
+        prefix = block.pow_prefix()
+        suffix = block.merkle_tree.merkle_root
+        if self.mining_workers > 1:
+            block.nonce, block.hash = self._mine_parallel(prefix, suffix, block.nonce)
+        else:
+            prefix_hasher = hashlib.sha256(prefix, usedforsecurity=False)
+            block.nonce, block.hash = mine(prefix_hasher, suffix, block.nonce)
         return block.hash
 
+    def _mine_parallel(self, prefix, suffix, start):
+        workers = self.mining_workers
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # each worker takes every workers-th nonce from its own offset, so no nonce is tried twice
+                stop = start + workers * MINING_BATCH
+                futures = [executor.submit(mine_range, prefix, suffix, start + i, workers, stop)
+                           for i in range(workers)]
+                found = [result for result in (future.result() for future in futures) if result is not None]
+                if found:
+                    return min(found)
+                start = stop
+
     def add_transaction(self, sender, receiver, amount):
         new_transaction = {
-            'sender': sender,
-            'receiver': receiver,
+            'sender': intern_name(sender),
+            'receiver': intern_name(receiver),
             'amount': amount
         }
         self.current_transactions.append(new_transaction)
 
-    def get_balance(self, person):
-        balance = 0
+    def _index_transactions(self, transactions):
+        for transaction in transactions:
+            sender = transaction['sender']
+            receiver = transaction['receiver']
+            amount = transaction['amount']
+            self._balances[sender] -= amount
+            self._balances[receiver] += amount
+            self._record_extremes(sender)
+            if receiver != sender:
+                self._record_extremes(receiver)
+            self._transaction_count += 1
+
+    def _record_extremes(self, person):
+        balance = self._balances[person]
+        extremes = self._extremes.get(person)
+        if extremes is None:
+            # balance was 0 after every earlier transaction in the chain
+            extremes = self._extremes[person] = [0, 0 if self._transaction_count else balance]
+        if balance < extremes[0]:
+            extremes[0] = balance
+        if balance > extremes[1]:
+            extremes[1] = balance
+
+    def _rebuild_index(self):
+        self._balances = defaultdict(int)
+        self._extremes = {}
+        self._transaction_count = 0
         for block in self.chain:
-            for transaction in block.transactions:
-                if transaction['sender'] == person:
-                    balance -= transaction['amount']
-                if transaction['receiver'] == person:
-                    balance += transaction['amount']
-        return balance
+            self._index_transactions(block.transactions)
 
-    def get_min_max_balance(self, person):
-        min_balance = 0
-        max_balance = float('-inf')
-        balance = 0
+    def get_balance(self, person):
+        return self._balances.get(person, 0)
 
-        for block in self.chain:
-            for transaction in block.transactions:
-                if transaction['sender'] == person:
-                    balance -= transaction['amount']
-                if transaction['receiver'] == person:
-                    balance += transaction['amount']
-                min_balance = min(min_balance, balance)
-                max_balance = max(max_balance, balance)
+    def get_min_max_balance(self, person):
+        extremes = self._extremes.get(person)
+        if extremes is None:
+            return 0, 0 if self._transaction_count else float('-inf')
+        return extremes[0], extremes[1]
 
-        return min_balance, max_balance
+    def _all_blocks(self, check, blocks):
+        if self.verify_workers > 1:
+            with ThreadPoolExecutor(max_workers=self.verify_workers) as executor:
+                return all(executor.map(check, blocks))
+        return all(map(check, blocks))
 
     def verify_chain(self):
-        for i in range(1, len(self.chain)):
-            current_block = self.chain[i]
-            previous_block = self.chain[i - 1]
-            if current_block.hash != current_block.generate_hash():
-                return False
+        for previous_block, current_block in zip(self.chain, self.chain[1:]):
             if current_block.previous_hash != previous_block.hash:
                 return False
-        return True
+        return self._all_blocks(Block.verify_hash, self.chain[1:])
 
     def verify_all_transactions(self):
-        for block in self.chain:
-            if not block.verify_transactions():
-                return False
-        return True
+        return self._all_blocks(Block.verify_transactions, self.chain)
 
     def get_positive_balance_users(self):
-        balance = {}
-        for block in self.chain:
-            for transaction in block.transactions:
-                sender = transaction['sender']
-                receiver = transaction['receiver']
-                amount = transaction['amount']
-                balance[sender] = balance.get(sender, 0) - amount
-                balance[receiver] = balance.get(receiver, 0) + amount
-        positive_balance_users = [user for user, bal in balance.items() if bal > 0]
-        return positive_balance_users
+        return [user for user, bal in self._balances.items() if bal > 0]
 
     def save_to_file(self, filename):
-        with open(filename, 'w') as file:
-            chain_data = [block.to_dict() for block in self.chain]
-            json.dump(chain_data, file)
+        with open(filename, 'wb') as file:
+            file.writelines(dump_json(block.to_dict()) + b'\n' for block in self.chain)
 
     def load_from_file(self, filename):
-        with open(filename, 'r') as file:
-            chain_data = json.load(file)
-            self.chain = [from_dict(block_data) for block_data in chain_data]
+        with open(filename, 'rb') as file:
+            self.chain = [from_dict(load_json(line)) for line in file if line.strip()]
+        self._rebuild_index()
 
 
 if __name__ == '__main__':